@@ -25,32 +25,28 @@ kul_pal2 = sns.color_palette(KUL_PAL2, as_cmap=True)
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
 
 def process_results(results: dict, type: str, fold: int, compression: int, macs: int, params: int):
-    """Calculate mean of main metrics"""
-
-    all_data = []
-
-    for res in results:
-        subject_data = {
-            'Format': type,
-            'Compression': compression,
-            'fold': fold,
-            'MACs': macs,
-            'Parameters': params,
-            'id': res['id'],
-            'Dice': res['test_dice_metric'],
-            'Dice ET': res['test_dice_et'],
-            'Dice TC': res['test_dice_tc'],
-            'Dice WT': res['test_dice_wt'],
-            '95% Hausdorff': res['test_hd_metric'],
-            '95% Hausdorff ET': res['test_hd_et'],
-            '95% Hausdorff TC': res['test_hd_tc'],
-            '95% Hausdorff WT': res['test_hd_wt'],
-        }
-
-        subject_df = pd.Series(subject_data)
-        all_data.append(subject_df)
-
-    all_df = pd.DataFrame(all_data)
+    """Build data frame of main metrics (results map output names to arrays, one value per subject)"""
+
+    # Column names in results, mapped to column names in data frame
+    columns = {
+        'id': 'id',
+        'test_dice_metric': 'Dice',
+        'test_dice_et': 'Dice ET',
+        'test_dice_tc': 'Dice TC',
+        'test_dice_wt': 'Dice WT',
+        'test_hd_metric': '95% Hausdorff',
+        'test_hd_et': '95% Hausdorff ET',
+        'test_hd_tc': '95% Hausdorff TC',
+        'test_hd_wt': '95% Hausdorff WT',
+    }
+
+    # Build data frame column-wise (constants are broadcast)
+    all_df = pd.DataFrame({column: results[key] for key, column in columns.items()})
+    all_df.insert(0, 'Format', type)
+    all_df.insert(1, 'Compression', compression)
+    all_df.insert(2, 'fold', fold)
+    all_df.insert(3, 'MACs', macs)
+    all_df.insert(4, 'Parameters', params)
 
     return all_df
 
@@ -61,7 +57,7 @@ if __name__ == '__main__':
     rebuild = True
     # Get all results files
     files = glob(join(hlp.LOG_DIR, 'results', '*', '*'))
-    files = [f for f in files if f.endswith('.npy')]
+    files = [f for f in files if f.endswith('.npz') or (f.endswith('.npy') and f[:-4] + '.npz' not in files)]
 
     # Get flops and params
     #flops_params = np.load(join(hlp.LOG_DIR, 'model_flops.npy'), allow_pickle=True).item()
@@ -88,7 +84,12 @@ if __name__ == '__main__':
                 macs = flops_params[type][compression]['macs']
                 params = flops_params[type][compression]['params']
 
-            results = np.load(f, allow_pickle=True)
+            if f.endswith('.npz'):
+                results = dict(np.load(f))
+            else:
+                # Older results were saved as a pickled list of dicts
+                results = np.load(f, allow_pickle=True)
+                results = {key: np.array([res[key] for res in results]) for key in results[0]}
             results_df = process_results(results, type=type, fold=fold, compression=compression, macs=macs, params=params)
 
             processed_results.append(results_df)
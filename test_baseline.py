@@ -86,7 +86,7 @@ if __name__ == '__main__':
 
         # Test inference method
         test_inference=test_inference,
-        test_inference_params={'overlap':.5},
+        test_inference_params={'overlap': .5, 'sw_batch_size': 4, 'mode': 'gaussian'},
     )
 
     # Load checkpoint
@@ -99,10 +99,12 @@ if __name__ == '__main__':
                             num_workers=8,
                             batch_size=1,
                             fold_index=fold_index)
-    brats.setup()
+    brats.setup('test')
 
     # Initialize logger
-    tb_logger = TensorBoardLogger(save_dir=tb_dir, name=model_name, default_hp_metric=False, version=version)
+    # (events are buffered, and only flushed to disk every five minutes)
+    tb_logger = TensorBoardLogger(save_dir=tb_dir, name=model_name, default_hp_metric=False, version=version,
+                                  flush_secs=300)
 
     # Initialize trainer
     log("Initializing trainer")
@@ -111,7 +113,9 @@ if __name__ == '__main__':
         logger=tb_logger,
         gpus=-1,
         #num_nodes=8,
-        deterministic=True,
+        precision=16,  # Mixed precision
+        benchmark=True,  # Let cuDNN pick the fastest (tensor core) kernels for our fixed input shape
+        deterministic=False,  # Deterministic mode would rule out most of those kernels
         #distributed_backend='ddp',
         callbacks=[
             LearningRateMonitor(logging_interval="step"),
@@ -138,4 +142,5 @@ if __name__ == '__main__':
             'n_param': model.get_n_parameters()}
 
     # Save test results
-    np.save(file=join(result_dir, f'{model_name}_v{version}_fold{fold_index}.npy'), arr=results)
+    np.savez_compressed(file=join(result_dir, f'{model_name}_v{version}_fold{fold_index}.npz'),
+                        **{key: np.array([res[key] for res in results]) for key in results[0]})
@@ -113,7 +113,9 @@ if __name__ == '__main__':
     brats.setup()
 
     # Initialize logger
-    tb_logger = TensorBoardLogger(save_dir=tb_dir, name=model_name, default_hp_metric=False, version=version)
+    # (events are buffered, and only flushed to disk every five minutes)
+    tb_logger = TensorBoardLogger(save_dir=tb_dir, name=model_name, default_hp_metric=False, version=version,
+                                  flush_secs=300)
 
     # Initialize trainer
     log("Initializing trainer")
@@ -122,7 +124,9 @@ if __name__ == '__main__':
         logger=tb_logger,
         gpus=-1,
         #num_nodes=1,
-        deterministic=True,
+        precision=16,  # Mixed precision
+        benchmark=True,  # Let cuDNN pick the fastest (tensor core) kernels for our fixed input shape
+        deterministic=False,  # Deterministic mode would rule out most of those kernels
         #distributed_backend='ddp',
         callbacks=[
             LearningRateMonitor(logging_interval="step"),
@@ -156,4 +160,5 @@ if __name__ == '__main__':
             'params': params}
 
     # Save test results
-    np.save(file=join(result_dir, f'{model_name}_v{version}_fold{fold_index}.npy'), arr=results)
+    np.savez_compressed(file=join(result_dir, f'{model_name}_v{version}_fold{fold_index}.npz'),
+                        **{key: np.array([res[key] for res in results]) for key in results[0]})
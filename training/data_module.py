@@ -7,53 +7,70 @@
 """
 BraTS data module for use in training functions
 """
-from glob import glob
-from os import listdir
+import os
+from copy import deepcopy
+from functools import lru_cache
 from os.path import join
 
-from monai.data import Dataset, DataLoader
+from monai.data import CacheDataset, Dataset, DataLoader, PersistentDataset
 from pytorch_lightning import LightningDataModule
 from sklearn.model_selection import train_test_split, KFold
 
+import utils.helper as hlp
 from utils.helper import *
 from training.transforms import *
 
 
+# Input modalities, in channel order
+MODALITIES = ('t1', 't1ce', 't2', 'flair')
+
+
 # Get dict mapping subjects with data paths
 def get_data(root_dir, labeled=True):
     """
     Given a directory, return a dictionary containing the file paths to all image data
+    (cached as long as the directory is unmodified)
     :param root_dir: data directory
     :return: path dict
     """
     assert root_dir.split('/')[-1].startswith('MICCAI_BraTS2020'), 'Invalid directory!'
 
+    patients = _get_data_cached(root_dir, labeled, os.stat(root_dir).st_mtime_ns)
+
+    # Hand out a copy, so callers can't alter the cache
+    return deepcopy(patients)
+
+
+@lru_cache(maxsize=8)
+def _get_data_cached(root_dir, labeled, mtime):
+
     # Store data
     patients = []
 
-    # Get patient folders
-    ids = [id for id in sorted(listdir(root_dir)) if id.startswith('BraTS20')]
+    # Get patient folders (skipping system files and csv's in the same scan)
+    ids = sorted(entry.name for entry in os.scandir(root_dir) if entry.is_dir() and entry.name.startswith('BraTS20'))
 
     # Loop over patient folders
     for id in ids:
 
-        # Avoid system files
-        if id.startswith('.'):
-            continue
+        # Map modalities (and segmentation) to files, in a single pass over the folder
+        files = {}
+        for entry in os.scandir(join(root_dir, id)):
+            stem = entry.name.split('.')[0]
+            for key in MODALITIES:
+                if stem.endswith(key):
+                    files[key] = entry.path
+            if 'seg' in stem:
+                files['seg'] = entry.path
 
         # Build path dict
         path_dict = {
             'id': id,
-            'input': [
-                glob(join(root_dir, id, "*t1.*"))[0],
-                glob(join(root_dir, id, "*t1ce.*"))[0],
-                glob(join(root_dir, id, "*t2.*"))[0],
-                glob(join(root_dir, id, "*flair.*"))[0],
-            ]
+            'input': [files[modality] for modality in MODALITIES]
         }
         # Add path to segmentation target (only for training data)
         if labeled:
-            path_dict['target'] = glob(join(root_dir, id, "*seg*"))[0]
+            path_dict['target'] = files['seg']
         patients.append(path_dict)
 
     return patients
@@ -73,7 +90,9 @@ class BraTSDataModule(LightningDataModule):
             num_workers: int=0,
             batch_size: int =1,
             n_folds=5,
-            fold_index:int=0
+            fold_index:int=0,
+            cache_rate: float = 1.0,
+            cache_dir=None,
     ):
         super().__init__()
 
@@ -95,6 +114,13 @@ class BraTSDataModule(LightningDataModule):
         # Index of split (fold)
         self.fold_index = fold_index
 
+        # Fraction of training data kept in memory (after deterministic transforms)
+        self.cache_rate = cache_rate
+
+        # Directory in which preprocessed validation/test data are persisted (not in the data directory,
+        # which may be read-only, and whose modification time is used to cache get_data)
+        self.cache_dir = join(hlp.LOG_DIR, 'monai_cache', os.path.basename(data_dir)) if cache_dir is None else cache_dir
+
         # Get all transforms
         self.training_transform = get_train_transform(patch_dim=self.patch_dim)
         self.validation_transform = get_val_transform(patch_dim=self.patch_dim)
@@ -114,12 +140,13 @@ class BraTSDataModule(LightningDataModule):
         # Get data paths
         self.data = get_data(self.data_dir)
 
-        # 5-fold validation
+        # k-fold validation
         splitter = KFold(n_splits=self.n_folds, shuffle=True, random_state=616)
         splits = splitter.split(self.data)
 
-        # Store all folds (loop over generator)
-        self.folds = [next(splits) for _ in range(5)]
+        # Store all folds (exhaust generator)
+        self.folds = list(splits)
+        assert len(self.folds) == self.n_folds, 'Unexpected number of folds!'
 
         # Get training and validation data, depending on fold index
         self.training_data = [self.data[idx] for idx in self.folds[self.fold_index][0]]
@@ -140,23 +167,29 @@ class BraTSDataModule(LightningDataModule):
         # Assign training datasets (train & val) for use in dataloaders
         if stage == "fit" or stage is None:
 
-            # Build training and validation sets (monai Dataset subclass)
-            self.training_set = Dataset(
+            # Build training and validation sets (monai Dataset subclasses)
+            # * training data are cached in memory up to the first random transform
+            # * validation transforms are deterministic, so their results are persisted on disk
+            self.training_set = CacheDataset(
                 data=self.training_data,
-                transform=self.training_transform
+                transform=self.training_transform,
+                cache_rate=self.cache_rate,
+                num_workers=self.num_workers,
             )
-            self.validation_set = Dataset(
+            self.validation_set = PersistentDataset(
                 data=self.validation_data,
-                transform=self.validation_transform
+                transform=self.validation_transform,
+                cache_dir=join(self.cache_dir, f'validation_{self.patch_dim}'),
             )
 
         # Assign test dataset for use in dataloader(s)
         if stage == "test" or stage is None:
 
-            # Build test set
-            self.test_set = Dataset(
+            # Build test set (deterministic, so persisted on disk as well)
+            self.test_set = PersistentDataset(
                 data=self.test_data,
-                transform=self.test_transform
+                transform=self.test_transform,
+                cache_dir=join(self.cache_dir, 'test'),
             )
 
         # Assign test dataset for visualization (inspect the results of our training)
@@ -172,31 +205,39 @@ class BraTSDataModule(LightningDataModule):
     # DATA LOADERS (monai Dataloader subclass) #
     ############################################
 
+    def _loader_params(self):
+        """Keyword arguments shared by all data loaders"""
+        params = {
+            'batch_size': self.batch_size,
+            'num_workers': self.num_workers,
+            'pin_memory': True,  # Copy Tensors in CUDA pinned memory before returning them
+        }
+
+        # Keep workers alive between epochs, and let them prefetch a few batches (only with multiprocessing)
+        if self.num_workers > 0:
+            params.update(persistent_workers=True, prefetch_factor=4)
+
+        return params
+
     def train_dataloader(self):
         training_loader = DataLoader(
             dataset=self.training_set,
-            batch_size=self.batch_size,
             shuffle=True,  # Reshuffle dataset at every epoch
-            num_workers=self.num_workers,
-            pin_memory=False,  # Copy Tensors in CUDA pinned memory before returning them
+            **self._loader_params(),
         )
         return training_loader
 
     def val_dataloader(self):
         validation_loader = DataLoader(
             self.validation_set,
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            pin_memory=False,
+            **self._loader_params(),
         )
         return validation_loader
 
     def test_dataloader(self):
         test_loader = DataLoader(
             self.test_set,
-            batch_size=self.batch_size,
-            num_workers=self.num_workers,
-            pin_memory=False,
+            **self._loader_params(),
         )
         return test_loader
 
@@ -20,6 +20,7 @@ from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
 from tqdm import tqdm
 
 import utils.helper as hlp
+from models.air_unet import AirUNet
 from models.baseline_unet import UNet
 from training.data_module import BraTSDataModule
 from training.lightning import UNetLightning
@@ -62,19 +63,20 @@ def val_inference(input: torch.Tensor, model: nn.Module):
     return output
 
 
-def test_inference(input: torch.Tensor, model: nn.Module, roi_dim:int = 128, **kwargs):
+def test_inference(input: torch.Tensor, model: nn.Module, roi_dim:int = 128, sw_batch_size:int = 4, **kwargs):
     """
     Inference function for test data, using sliding window
 
     :param input: test data tensor
     :param model: model through which input is passed
+    :param sw_batch_size: number of windows passed through the model at once
     :return: model output (segmentation)
     """
 
     # Generate output using sliding window (sized 128^3)
     output = sliding_window_inference(
         inputs=input, roi_size=(roi_dim, roi_dim, roi_dim),
-        sw_batch_size=1, predictor=model, **kwargs
+        sw_batch_size=sw_batch_size, predictor=model, **kwargs
     )
 
     # Post transforms
@@ -139,44 +141,28 @@ if __name__ == '__main__':
         hlp.set_dir(write_dir)
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-        # Load model
-        model = UNetLightning(
+        # Load from checkpoint (callables aren't stored in checkpoints, so pass them again; they're checked by name)
+        checkpoint_path = join(hlp.LOG_DIR, 'snapshots',model_name, f'final_{model_name}_v{version}_fold{fold_index}.ckpt')
+
+        model = UNetLightning.load_from_checkpoint(
+            checkpoint_path=checkpoint_path,
 
             # Architecture settings
-            network=UNet,
-            network_params={
-                'in_channels': 4,
-                'out_channels': 3,
-                'widths': (32, 64, 128, 256, 320),
-                'head': False},
+            network=UNet if type == 'baseline' else AirUNet,
 
             # Loss and metrics
             loss=dice_loss,
             metrics=[dice_metric, dice_et, dice_tc, dice_wt,
                      hd_metric, hd_et, hd_tc, hd_wt],
 
-            # Optimizer
+            # Optimizer and learning rate scheduler
             optimizer=optim.AdamW,
-            optimizer_params={'lr': 1e-4, 'weight_decay': 1e-5},
-
-            # Learning rate scheduler
             scheduler=CosineAnnealingWarmRestarts,
-            scheduler_config={'interval': 'epoch'},
-            scheduler_params={'T_0': 50, 'eta_min': 3e-5},
 
-            # Inference method
+            # Inference methods
             inference=val_inference,
-            inference_params=None,
-
-            # Test inference method
             test_inference=test_inference,
-            test_inference_params={'overlap': .5},
         )
-
-        # Load from checkpoint
-        checkpoint_path = join(hlp.LOG_DIR, 'snapshots',model_name, f'final_{model_name}_v{version}_fold{fold_index}.ckpt')
-
-        model = model.load_from_checkpoint(checkpoint_path=checkpoint_path)
         model = model.to(device)
 
         # Predict a sample
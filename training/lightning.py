@@ -8,12 +8,38 @@
 Lightning wrapper for model, to facilitate training
 """
 
+import torch
 import torch.nn.functional as F
 from torch import nn
 from torch import optim
 from pytorch_lightning.core import LightningModule
 from time import time
 
+from utils.helper import log
+
+
+# Arguments that aren't saved as hyperparameters
+CALLABLES = ('network', 'loss', 'metrics', 'optimizer', 'scheduler', 'inference', 'test_inference')
+
+
+# Name of a callable (or a sequence of callables)
+def _name(f):
+    if isinstance(f, (list, tuple)):
+        return [_name(g) for g in f]
+    return None if f is None else getattr(f, "__name__", type(f).__name__)
+
+
+# Average each metric over the step outputs of an epoch (outputs are tensors, returns floats)
+# Steps with nan (e.g. dice for an empty ground truth) are left out, like monai's reduction does
+def _aggregate(outputs):
+    keys = list(outputs[0].keys())
+    means = []
+    for k in keys:
+        x = torch.stack([o[k].detach() for o in outputs])
+        means.append(x[~torch.isnan(x)].mean())
+    return dict(zip(keys, torch.stack(means).tolist()))
+
+
 ####################################
 # Lightning wrapper for UNet model #
 ####################################
@@ -34,8 +60,10 @@ class UNetLightning(LightningModule):
         scheduler_config=None,
         inference=nn.Identity,
         inference_params=None,
-            test_inference=None,
-            test_inference_params=None,
+        test_inference=None,
+        test_inference_params=None,
+        channels_last=True,
+        compile_net=True,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -46,6 +74,19 @@ class UNetLightning(LightningModule):
         # Initialize network
         self.net = network(**self.network_params)
 
+        # Store weights in channels-last format, so cuDNN can use tensor core kernels
+        self.channels_last = channels_last
+        if self.channels_last:
+            self.net = self.net.to(memory_format=torch.channels_last_3d)
+
+        # Compile forward pass (torch 2.0+). We compile the bound method rather than the module itself,
+        # so parameter names (and thus checkpoints) are unaffected.
+        self.compiled_forward = None
+        if compile_net and hasattr(torch, "compile"):
+            self.compiled_forward = torch.compile(
+                self.net.forward, mode="max-autotune-no-cudagraphs", dynamic=False, fullgraph=False
+            )
+
         # Set loss
         self.loss = loss
         self.loss_params = {} if loss_params is None else loss_params
@@ -86,8 +127,22 @@ class UNetLightning(LightningModule):
         # Test results
         self.test_results = None
 
-        # Save hyperparameters
-        self.save_hyperparameters()
+        # Save hyperparameters (callables are left out, they're only stored by name, see on_save_checkpoint)
+        self.save_hyperparameters(ignore=list(CALLABLES))
+        self.callable_names = {
+            k: _name(v) for k, v in zip(CALLABLES, (network, loss, metrics, optimizer, scheduler, inference, test_inference))
+        }
+
+    # Store names of callables in checkpoint (these aren't saved as hyperparameters)
+    def on_save_checkpoint(self, checkpoint):
+        checkpoint["callable_names"] = self.callable_names
+
+    # Check whether callables passed at load time match the ones the checkpoint was saved with
+    def on_load_checkpoint(self, checkpoint):
+        for k, name in checkpoint.get("callable_names", {}).items():
+            if self.callable_names.get(k) != name:
+                log(f"WARNING: checkpoint was saved with {k} <{name}>, but got <{self.callable_names.get(k)}>.",
+                    verbosity=1, color='red')
 
     # Get total number of learnable weights
     def get_n_parameters(self):
@@ -95,7 +150,9 @@ class UNetLightning(LightningModule):
 
     # Feedforward
     def forward(self, x):
-        return self.net(x)
+        if self.compiled_forward is None:
+            return self.net(x)
+        return self.compiled_forward(x)
 
     # Configure optimization and LR schedule
     def configure_optimizers(self):
@@ -113,6 +170,12 @@ class UNetLightning(LightningModule):
 
         return config
 
+    # Convert input to channels-last format (on the device, so the copy from pinned memory stays asynchronous)
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if self.channels_last:
+            batch["input"] = batch["input"].contiguous(memory_format=torch.channels_last_3d)
+        return batch
+
     ############
     # Training #
     ############
@@ -123,7 +186,9 @@ class UNetLightning(LightningModule):
         # Get new input and predict, then calculate loss
         x, y = batch["input"], batch["target"]
         y_hat = self(x)
-        loss = self.loss(y_hat, y, **self.loss_params)
+
+        # Calculate loss in full precision (also under mixed precision training)
+        loss = self.loss(y_hat.float(), y, **self.loss_params)
 
         # Log output and calculate metrics
         self.log(f"train_{self.loss.__name__}", loss, prog_bar=True)
@@ -132,20 +197,8 @@ class UNetLightning(LightningModule):
     # Training epoch end
     def training_epoch_end(self, outputs):
 
-        # Metrics we'll log
-        metrics_dict = dict.fromkeys(outputs[0])
-
-        # Loop over metrics
-        for metric_name in metrics_dict:
-
-            # Average metric over outputs within epoch
-            metric_total = 0.0
-            for output in outputs:
-                metric_total += output[metric_name]
-            metric_value = metric_total / len(outputs)
-
-            if hasattr(metric_value, "item"):
-                metric_value = metric_value.item()
+        # Average metrics over outputs within epoch, and log them
+        for metric_name, metric_value in _aggregate(outputs).items():
             self.log(metric_name, metric_value, prog_bar=True)
 
             # Log using Tensorboard logger TODO: Check if this is necessary, and how this compares to self.log
@@ -157,35 +210,26 @@ class UNetLightning(LightningModule):
         # Get new input and predict, then calculate loss
         x, y = batch["input"], batch["target"]
 
-        y_hat = self.inference(x, self, **self.inference_params)
+        # The inference function applies the sigmoid and threshold (once), so metrics get a binary prediction
+        with torch.inference_mode():
+            y_hat = self.inference(x, self, **self.inference_params)
+
+            # Calculate metrics
+            output = {}
+            for m, pars in zip(self.metrics, self.metrics_params):
+                output[f"val_{m.__name__}"] = m(y_hat, y, **pars)
 
-        # Calculate metrics
-        output = {}
-        for m, pars in zip(self.metrics, self.metrics_params):
-            output[f"val_{m.__name__}"] = m(y_hat, y, **pars)
         return output
 
     # Validation epoch end
     def validation_epoch_end(self, outputs):
 
-        # Metrics we'll log
-        metrics_dict = dict.fromkeys(outputs[0])
-
-        # Loop over metrics
-        for metric_name in metrics_dict:
-
-            # Average metric over outputs within epoch
-            metric_total = 0.0
-            for output in outputs:
-                metric_total += output[metric_name]
-            metric_value = metric_total / len(outputs)
-
-            if hasattr(metric_value, "item"):
-                metric_value = metric_value.item()
+        # Average metrics over outputs within epoch, and log them
+        for metric_name, metric_value in _aggregate(outputs).items():
             self.log(metric_name, metric_value, prog_bar=True)
 
             # Log using Tensorboard logger
-            self.logger.experiment.add_scalar(f"{metric_name}/val",metric_value,self.current_epoch)
+            self.logger.experiment.add_scalar(f"{metric_name}/val", metric_value, self.current_epoch)
 
     # Test step
     def test_step(self, batch, batch_idx):
@@ -205,7 +249,8 @@ class UNetLightning(LightningModule):
 
         # Infer and time inference
         start = time()
-        y_hat = self.test_inference(x, self, **self.test_inference_params)
+        with torch.inference_mode():
+            y_hat = self.test_inference(x, self, **self.test_inference_params)
         end = time()
 
         # Calculate metrics
@@ -218,12 +263,10 @@ class UNetLightning(LightningModule):
         # Add other metrics to output dict
         for m, pars in zip(self.metrics, self.metrics_params):
 
-            metric_value = m(y_hat, y, **pars)
-
-            if hasattr(metric_value, "item"):
-                metric_value = metric_value.item()
+            with torch.inference_mode():
+                metric_value = m(y_hat, y, **pars)
 
-            output[f"test_{m.__name__}"] = metric_value
+            output[f"test_{m.__name__}"] = metric_value.item()
 
         return output
 
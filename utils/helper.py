@@ -3,10 +3,11 @@ Helper functions
 """
 
 import os
+import sys
 import time
 from os.path import join
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
 
 from colorama import Fore, Style
 from pytorch_lightning import seed_everything
@@ -20,6 +21,20 @@ LOG_DIR = join(Path(os.path.dirname(os.path.abspath(__file__))).parents[1], 'log
 TENSOR_NET_TYPES = ['cp', 'cpd', 'canonical', 'tucker', 'train', 'tensor-train', 'tt']
 KUL_PAL = ['#FF7251', '#C58B85', '#8CA5B8', '#52BEEC']
 KUL_PAL2 = ['#FF7251', '#E67D67', '#CE887D','#B59393','#9C9DAA','#83A8C0','#6BB3D6','#52BEEC']
+COLORS = {
+    'red': Fore.RED,
+    'blue': Fore.BLUE,
+    'green': Fore.GREEN,
+    'yellow': Fore.YELLOW,
+    'magenta': Fore.MAGENTA,
+    'cyan': Fore.CYAN,
+}
+
+# Whether hi already seeded this process
+_SEEDED = False
+
+# Last formatted timestamp (see log)
+_last_second, _last_timestamp = None, None
 
 # Set parameters
 def set_params(verbosity: int = None, timestamped: bool = None, data_dir: str = None, log_dir: str = None):
@@ -39,11 +54,15 @@ def set_params(verbosity: int = None, timestamped: bool = None, data_dir: str =
     LOG_DIR = os.path.abspath(LOG_DIR)
 
 
-def hi(title=None, **params):
+def hi(title=None, seed: Optional[int] = None, **params):
     """
     Say hello. (It's stupid, I know.)
     If there's anything to initialize, do so here.
+
+    :param title: title to print
+    :param seed: reseed with this value (by default, we only seed once per process)
     """
+    global _SEEDED
 
     print("\n")
     print(Fore.BLUE, end='')
@@ -71,8 +90,10 @@ def hi(title=None, **params):
     if not os.path.exists(DATA_DIR) or not os.path.exists(LOG_DIR):
          set_dir(DATA_DIR, LOG_DIR)
 
-    # Set seed
-    seed_everything(616, workers=True)
+    # Set seed (once, unless asked to reseed)
+    if seed is not None or not _SEEDED:
+        seed_everything(616 if seed is None else seed, workers=True)
+        _SEEDED = True
 
 
 # Expand on what happens to input when sent through layer
@@ -104,44 +125,47 @@ def log(*message, verbosity=3, sep="", timestamped=None, title=False, color=None
     :return: /
     """
 
-    # Set colors
-    color_dict = {
-        'red': Fore.RED,
-        'blue': Fore.BLUE,
-        'green': Fore.GREEN,
-        'yellow': Fore.YELLOW,
-        'magenta': Fore.MAGENTA,
-        'cyan': Fore.CYAN,
-    }
-    if color and color in color_dict:
-        color = color_dict[color]
-
     # Title always get shown
     verbosity = 1 if title else verbosity
 
-    # Print if log level is sufficient
-    if verbosity <= VERBOSITY:
+    # Skip (and don't bother formatting) if log level is insufficient
+    if verbosity > VERBOSITY:
+        return
 
-        # Print title
-        if title:
-            n = len(*message)
-            if color:
-                print(color, end='')
-            print('\n' + (n + 4) * '#')
-            print('# ', *message, ' #', sep='')
-            print((n + 4) * '#' + '\n' + Style.RESET_ALL)
+    # Set colors
+    color = COLORS.get(color, color) if color else ''
 
-        # Print regular
-        else:
-            ts = timestamped if timestamped is not None else TIMESTAMPED
-            t = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            if color:
-                print(color, end='')
-            print((str(t) + (" - " if sep == "" else "-")) if ts else "", *message, Style.RESET_ALL, sep=sep)
+    # Print title
+    if title:
+        n = len(*message)
+        sys.stdout.write(''.join((
+            color,
+            '\n', (n + 4) * '#', '\n',
+            '# ', *message, ' #', '\n',
+            (n + 4) * '#', '\n', Style.RESET_ALL, '\n',
+        )))
+
+    # Print regular
+    else:
+        ts = timestamped if timestamped is not None else TIMESTAMPED
+        prefix = (_timestamp() + (" - " if sep == "" else "-")) if ts else ""
+        sys.stdout.write(color + sep.join((prefix, *map(str, message), Style.RESET_ALL)) + '\n')
 
     return
 
 
+def _timestamp():
+    """Current time as a string (only formatted once per second)"""
+    global _last_second, _last_timestamp
+
+    second = int(time.time())
+    if second != _last_second:
+        _last_second = second
+        _last_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+
+    return _last_timestamp
+
+
 def time_it(f: Callable):
     """
     Timer decorator: shows how long execution of function took.
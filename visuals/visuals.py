@@ -46,7 +46,7 @@ if __name__ == '__main__':
     brats = BraTSDataModule(data_dir=join(hlp.DATA_DIR, "MICCAI_BraTS2020_TrainingData"),
                             num_workers=8,
                             batch_size=1)
-    brats.setup()
+    brats.setup('visualize')
 
     # Get an image
     idx = 16      # Sample id: 'BraTS20_Training_102'